@@ -1,8 +1,13 @@
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
+import gzip
+import tempfile
+from itertools import combinations
+from time import time
 from typing import Tuple, Union, List
 
 import numpy as np
-from batchgenerators.augmentations.utils import resize_segmentation
+from batchgenerators.augmentations.utils import resize_segmentation, pad_nd_image
 from nnunet.inference.segmentation_export import save_segmentation_nifti_from_softmax, save_segmentation_nifti
 from batchgenerators.utilities.file_and_folder_operations import *
 #from multiprocessing import Process, Queue
@@ -10,18 +15,23 @@ from queue import Queue
 
 # from multiprocessing.dummy import Queue
 import torch
+from torch.cuda.amp import autocast
 import SimpleITK as sitk
 import shutil
 
 from nnunet.postprocessing.connected_components import load_remove_save, load_postprocessing
 from nnunet.training.model_restore import load_model_and_checkpoint_files
 from nnunet.training.network_training.nnUNetTrainer import nnUNetTrainer
+from nnunet.network_architecture.neural_network import SegmentationNetwork
 from nnunet.utilities.one_hot_encoding import to_one_hot
+from nnunet.utilities.random_stuff import no_op
 
 import cc3d
+from scipy.ndimage import find_objects
 import torch.nn.functional as F
 import segmentation_models_pytorch as smp
 import torchio
+import nibabel as nib
 from einops import rearrange
 
 
@@ -31,7 +41,488 @@ def con_comp(seg_array):
     return conn_comp
 
 
-def predict_2d(model_path, input_folder):
+def get_memory_budget(fraction=0.85):
+    """
+    Returns the number of bytes predict_cases may use on the host. The container is started with a hard memory
+    limit (see test.sh), so the cgroup limit is honoured if it is smaller than the physical memory.
+    :param fraction: share of the limit we allow ourselves to use (* 0.85 just to be save)
+    :return:
+    """
+    limit = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    for cgroup_file in ('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory/memory.limit_in_bytes'):
+        if isfile(cgroup_file):
+            with open(cgroup_file) as f:
+                value = f.read().strip()
+            if value.isdigit():
+                limit = min(limit, int(value))
+    return int(limit * fraction)
+
+
+def estimate_stage_peaks(data_shape, raw_shape, num_classes, dtype=np.float32, memmap=False, all_in_gpu=False,
+                         patch_batching=False, stream_2d=False, patch_size=None, patch_batch_size=None):
+    """
+    Rough upper bound of the host memory (in bytes) each stage of predict_cases needs for a single case.
+    :param data_shape: shape of the preprocessed data (modalities, x, y, z)
+    :param raw_shape: shape of the raw image as read by SimpleITK (z, y, x)
+    :param num_classes: number of output channels of the 3D network
+    :param dtype: dtype of the softmax accumulation buffer
+    :param memmap: if True the case is predicted out of core: all folds are aggregated by
+    predict_preprocessed_data_batched into a single memory-mapped buffer and the softmax is memory-mapped as well
+    :param all_in_gpu: if True nnUNet aggregates the sliding window on the GPU and returns float16
+    :param patch_batching: if True the sliding window is run by predict_preprocessed_data_batched
+    :param stream_2d: if True predict_2d reads the PET slab by slab into a memory-mapped output
+    :param patch_size: patch size of the 3D network, needed if memmap or patch_batching
+    :param patch_batch_size: number of patch locations per forward pass of predict_preprocessed_data_batched. None
+    (not tuned yet): a single location
+    :return: dict stage -> bytes
+    """
+    n = int(np.prod(data_shape[1:], dtype=np.int64))
+    n_raw = int(np.prod(raw_shape, dtype=np.int64))
+    acc_bytes = np.dtype(dtype).itemsize
+
+    data = data_shape[0] * n * 4
+    softmax = 0 if memmap else num_classes * n * acc_bytes
+    if memmap or patch_batching:
+        # predict_preprocessed_data_batched pads a copy of the data and holds the predictions (float32), flat indices
+        # (int64) and gaussian weights (float32) of the current batch on the host
+        padded = data_shape[0] * int(np.prod([max(s, p) for s, p in zip(data_shape[1:], patch_size)],
+                                             dtype=np.int64)) * 4
+        batch = (patch_batch_size or 1) * int(np.prod(patch_size, dtype=np.int64)) * (4 * num_classes + 8 + 4)
+    if memmap:
+        fold = padded + batch  # the aggregation buffers are memory-mapped
+    elif all_in_gpu:
+        fold = num_classes * n * 2  # only the returned float16 softmax lives on the host
+    elif patch_batching:
+        fold = (num_classes + 1) * n * 4 + padded + batch  # the returned softmax is a view of the aggregation buffer
+    else:
+        fold = 3 * num_classes * n * 4  # aggregated results, number of predictions and the returned softmax
+
+    # predict_2d runs concurrently with the 3D prediction of the same case and with the fusion and export of the
+    # previous case
+    if stream_2d:
+        # one batch of 16 slices: the slab with its 4 neighbouring slices, the stacked 5 slice inputs and the
+        # probabilities resized back, all at the native (h, d) of the PET (nibabel order, i.e. raw_shape reversed),
+        # plus the inputs and probabilities at 400 x 400
+        h, d = raw_shape[1], raw_shape[0]
+        branch_2d = ((16 + 4) + 16 * 5 + 16) * h * d * 4 + 16 * (5 + 1) * 400 * 400 * 4
+    else:
+        branch_2d = 2 * n_raw * 4 + n_raw * 4  # PET, its rescaled copy and the output
+
+    peaks = {
+        # the accumulation buffer and the softmax of the fold currently being predicted
+        'prediction': data + softmax + fold + branch_2d,
+        # float32 copy of the foreground probability (unless it already is float32), result, softmax_2d,
+        # high/low/cue masks and the connected component labels
+        'fusion': data + softmax + n * ((4 if acc_bytes != 4 else 0) + 4 + 4 + 3 + 4) + branch_2d,
+        # save_segmentation_nifti_from_softmax loads the softmax and resamples it in float64
+        'export': data + num_classes * n * acc_bytes + num_classes * n_raw * 8 + n_raw + branch_2d,
+    }
+    return peaks
+
+
+def plan_memory(data_shape, raw_shape, num_classes, budget, all_in_gpu=False, patch_batching=False,
+                stream_2d=False, patch_size=None, patch_batch_size=None):
+    """
+    Picks the cheapest-to-use accumulation strategy that keeps every stage of predict_cases under budget.
+    Candidates are tried in order: float32 softmax in memory, float16 softmax in memory and out of core. Out of core
+    the case goes through predict_preprocessed_data_batched, which aggregates all folds into a single
+    memory-mapped buffer, and the float16 softmax is memory-mapped too. If nothing fits we still go out of core,
+    which keeps everything but fusion, export and the 2D branch on disk.
+    :return: dict with keys 'dtype', 'memmap' and 'peaks'
+    """
+    candidates = [(np.float32, False), (np.float16, False), (np.float16, True)]
+    if all_in_gpu:
+        candidates = candidates[1:]  # nnUNet returns float16 anyway
+
+    for dtype, memmap in candidates:
+        peaks = estimate_stage_peaks(data_shape, raw_shape, num_classes, dtype, memmap, all_in_gpu, patch_batching,
+                                     stream_2d, patch_size, patch_batch_size)
+        if max(peaks.values()) <= budget:
+            break
+    else:
+        print("WARNING! Estimated peak memory of %.2f GB exceeds the budget of %.2f GB even out of core" %
+              (max(peaks.values()) / 1e9, budget / 1e9))
+
+    print("memory plan: %s softmax%s, budget %.2f GB, estimated peaks %s" %
+          (np.dtype(dtype).name, " (out of core)" if memmap else "", budget / 1e9,
+           ", ".join("%s %.2f GB" % (k, v / 1e9) for k, v in peaks.items())))
+    return {'dtype': dtype, 'memmap': memmap, 'peaks': peaks}
+
+
+def allocate_buffer(shape, dtype, memmap_file=None):
+    """
+    Allocates an accumulation buffer, either in memory or as a .npy file mapped into memory. The .npy file can be
+    passed as is to save_segmentation_nifti_from_softmax, which will load and delete it.
+    """
+    if memmap_file is None:
+        return np.zeros(shape, dtype=dtype)
+    return np.lib.format.open_memmap(memmap_file, mode='w+', dtype=dtype, shape=tuple(shape))
+
+
+def fuse_predictions(softmax_3d, softmax_2d):
+    """
+    Fuses the foreground probability of the 3D nnUNet with the 2D cue. Every connected component is only looked at
+    within its bounding box, so apart from the masks and label maps no full-volume temporaries are created.
+    :param softmax_3d: foreground probability of the 3D network (z, y, x)
+    :param softmax_2d: foreground probability of the 2D network (z, y, x)
+    :return: binary foreground in the dtype of softmax_3d. Pass float32, in float16 all voxels within ~2.4e-4 of a
+    component's maximum compare equal to it
+    """
+    result = np.zeros_like(softmax_3d)
+
+    high = (softmax_3d > 0.90)
+    low = (softmax_3d > 0.50)
+    cue = (softmax_2d > 0.50)
+
+    comp = con_comp(high)
+    high_record = np.bincount(comp.ravel())
+    high_record[0] = 0
+    del comp
+    comp = con_comp(low)
+    low_record = np.bincount(comp.ravel())
+    low_record[0] = 0
+
+    if np.max(high_record) < 50 and np.max(low_record) < 150:
+        return result
+
+    for idx, bbox in enumerate(find_objects(comp), start=1):
+        comp_mask = comp[bbox] == idx
+        prob = softmax_3d[bbox] * comp_mask
+        overlap_3d = np.sum(comp_mask & high[bbox])
+        overlap_2d = np.max(comp_mask & cue[bbox])
+        if overlap_3d < 20 or overlap_2d == 0:
+            result[bbox][prob == prob.max()] = 1
+        elif overlap_3d > 30000:
+            result[bbox] += comp_mask & high[bbox]
+        else:
+            result[bbox] += comp_mask
+    del comp
+
+    comp = con_comp(cue)
+    cue_record = np.bincount(comp.ravel())
+    cue_record[0] = 0
+    retain = len(low_record) + 6
+    if len(cue_record) >= retain:
+        area = np.sort(cue_record)[-retain]
+    else:
+        area = 35
+    for idx, bbox in enumerate(find_objects(comp), start=1):
+        comp_mask = comp[bbox] == idx
+        prob = softmax_3d[bbox] * comp_mask
+        overlap = np.sum(comp_mask * result[bbox])
+        if overlap > 0:
+            continue
+        elif np.max(prob) > 0.10:
+            result[bbox][prob == prob.max()] = 1
+        elif cue_record[idx] <= area:
+            continue
+        elif np.max(prob) < 1e-5:
+            continue
+        else:
+            result[bbox][prob == prob.max()] = 1
+
+    return result
+
+
+def get_mirror_flips(do_mirroring, mirror_axes):
+    """
+    Returns the tensor dims to flip for every test time mirroring, the identity first. This covers the same 2 **
+    len(mirror_axes) combinations as SegmentationNetwork._internal_maybe_mirror_and_pred_3D.
+    """
+    if not do_mirroring:
+        return [()]
+    dims = [a + 2 for a in mirror_axes]
+    return [c for k in range(len(dims) + 1) for c in combinations(dims, k)]
+
+
+def count_sliding_window_patches(patch_size, data_shape, step_size, do_mirroring, mirror_axes):
+    """
+    Number of patches (including their mirrored copies) the 3D sliding window runs through the network.
+    """
+    image_size = [max(i, j) for i, j in zip(data_shape[1:], patch_size)]
+    steps = SegmentationNetwork._compute_steps_for_sliding_window(patch_size, image_size, step_size)
+    return int(np.prod([len(i) for i in steps])) * len(get_mirror_flips(do_mirroring, mirror_axes))
+
+
+def tune_patch_batch_size(network, patch, num_flips, max_batch_size, mixed_precision, fraction=0.8, reserve=0):
+    """
+    Estimates how many patch locations (each with all its mirrored copies) fit into one forward pass. The memory a
+    single location needs is measured with one forward pass and the free GPU memory is divided by it. The peak
+    memory statistics are global to the device, so nothing else may run on the GPU meanwhile.
+    :param patch: one input patch (1, c, x, y, z) on the GPU
+    :param reserve: bytes of the free GPU memory to leave to others, e.g. the 2D branch
+    :return: 1 if not even a single location fits
+    """
+    if not torch.cuda.is_available():
+        return 1
+    context = autocast if mixed_precision else no_op
+    torch.cuda.synchronize()
+    torch.cuda.reset_peak_memory_stats()
+    baseline = torch.cuda.memory_allocated()
+    oom = False
+    try:
+        with torch.no_grad(), context():
+            network.inference_apply_nonlin(network(patch.repeat(num_flips, 1, 1, 1, 1)))
+    except RuntimeError as e:
+        if 'out of memory' not in str(e):
+            raise
+        oom = True
+    if oom:
+        torch.cuda.empty_cache()
+        return 1
+    per_location = max(torch.cuda.max_memory_allocated() - baseline, 1)
+    free = torch.cuda.mem_get_info()[0] + torch.cuda.memory_reserved() - torch.cuda.memory_allocated() - reserve
+    return int(max(1, min(max_batch_size, fraction * free // per_location)))
+
+
+def predict_preprocessed_data_batched(trainer, data, do_mirroring=True, mirror_axes=(0, 1, 2), step_size=0.5,
+                                      patch_batch_size='auto', all_in_gpu=False, mixed_precision=True,
+                                      params=None, aggregation_file=None):
+    """
+    Batched version of trainer.predict_preprocessed_data_return_seg_and_softmax for 3D sliding window inference
+    with gaussian importance weighting. patch_batch_size patch locations and all their mirrored copies go through
+    the network in a single forward pass. The gaussian weighted predictions are scatter-added into a flat
+    aggregation buffer with index_add_, which takes care of overlapping patches within a batch.
+    :param trainer: nnUNetTrainer with loaded parameters
+    :param data: preprocessed data (c, x, y, z)
+    :param patch_batch_size: number of patch locations per forward pass. 'auto': as many as fit into GPU memory.
+    If the GPU runs out of memory the batch size is halved
+    :param all_in_gpu: if True the aggregation buffer lives on the GPU and the result is returned as float16
+    :param params: if not None, the parameters of all folds are loaded one after the other and their predictions
+    are aggregated into the same buffer. The number of predictions per voxel is the same for every fold, so the
+    result is the fold average without a buffer per fold
+    :param aggregation_file: if not None (and not all_in_gpu) the aggregation buffers are .npy files
+    memory-mapped from aggregation_file and aggregation_file[:-4] + "_nb.npy". The returned softmax is a view of
+    aggregation_file, which the caller has to remove once done with it
+    :return: softmax (num_classes, x, y, z) and a dict with the patch batch size that was used in the end (pass it
+    on instead of 'auto' to not tune again) and the number of patches predicted in how many seconds, not counting
+    tuning and the first (warm up) batch
+    """
+    network = trainer.network
+    patch_size = [int(i) for i in trainer.patch_size]
+    assert len(patch_size) == 3, "batched patch execution is only implemented for 3D networks"
+    device = next(network.parameters()).device
+    context = autocast if mixed_precision else no_op
+
+    data, slicer = pad_nd_image(data, patch_size, 'constant', {'constant_values': 0}, True, None)
+    data_shape = data.shape[1:]
+    steps = SegmentationNetwork._compute_steps_for_sliding_window(patch_size, data_shape, step_size)
+    locations = np.array([(x, y, z) for x in steps[0] for y in steps[1] for z in steps[2]])
+    flips = get_mirror_flips(do_mirroring, mirror_axes)
+
+    aggregation_device = device if all_in_gpu else torch.device('cpu')
+    data = torch.from_numpy(data)
+    if all_in_gpu:
+        data = data.to(device)
+
+    gaussian = SegmentationNetwork._get_gaussian(patch_size, sigma_scale=1. / 8)
+    gaussian = torch.from_numpy(gaussian.astype(np.float32))
+    gaussian_flat = gaussian.reshape(-1).to(aggregation_device)
+    gaussian = gaussian.to(device)
+
+    # flat offsets of the voxels of a patch relative to its corner, in the padded volume
+    strides = np.array([data_shape[1] * data_shape[2], data_shape[2], 1])
+    offsets = (np.arange(patch_size[0])[:, None, None] * strides[0] +
+               np.arange(patch_size[1])[None, :, None] * strides[1] +
+               np.arange(patch_size[2])[None, None, :]).reshape(-1)
+    offsets = torch.from_numpy(offsets).to(aggregation_device)
+    corners = torch.from_numpy(locations @ strides).to(aggregation_device)
+
+    num_voxels = int(np.prod(data_shape))
+    if aggregation_file is not None and not all_in_gpu:
+        nb_file = aggregation_file[:-4] + "_nb.npy"
+        aggregated_results = torch.from_numpy(allocate_buffer((trainer.num_classes, num_voxels), np.float32,
+                                                              aggregation_file))
+        aggregated_nb_of_predictions = torch.from_numpy(allocate_buffer(num_voxels, np.float32, nb_file))
+    else:
+        nb_file = None
+        aggregated_results = torch.zeros((trainer.num_classes, num_voxels), dtype=torch.float32,
+                                         device=aggregation_device)
+        aggregated_nb_of_predictions = torch.zeros(num_voxels, dtype=torch.float32, device=aggregation_device)
+    if params is None:
+        params = [None]
+
+    ds = network.do_ds
+    current_mode = network.training
+    network.do_ds = False
+    network.eval()
+    try:
+        def get_patch(location):
+            x, y, z = location
+            return data[:, x:x + patch_size[0], y:y + patch_size[1], z:z + patch_size[2]]
+
+        if patch_batch_size == 'auto':
+            patch_batch_size = tune_patch_batch_size(network, get_patch(locations[0])[None].to(device), len(flips),
+                                                     len(locations), mixed_precision)
+            print("patch batch size:", patch_batch_size)
+
+        # the first batch warms up cuDNN for the batch shape and is not part of the timing
+        timed_patches = 0
+        timed_start = None
+        total_start = time()
+        for fold, p in enumerate(params):
+            if p is not None:
+                trainer.load_checkpoint_ram(p, False)
+                network.eval()
+            start = 0
+            while start < len(locations):
+                end = min(start + patch_batch_size, len(locations))
+                oom = False
+                try:
+                    x = torch.stack([get_patch(l) for l in locations[start:end]]).to(device, non_blocking=True)
+                    n = x.shape[0]
+                    with torch.no_grad():
+                        with context():
+                            inputs = torch.cat([torch.flip(x, f) if f else x for f in flips])
+                            out = network.inference_apply_nonlin(network(inputs))
+                        del inputs
+                        pred = sum(torch.flip(out[i * n:(i + 1) * n], f) if f else out[i * n:(i + 1) * n]
+                                   for i, f in enumerate(flips))
+                        del out
+                        pred = pred.float() * (gaussian / len(flips))
+                        # (n, classes, x, y, z) -> (classes, n * x * y * z), same order as idx
+                        pred = pred.transpose(0, 1).reshape(trainer.num_classes, -1).to(aggregation_device)
+                        idx = (corners[start:end, None] + offsets[None, :]).reshape(-1)
+                except RuntimeError as e:
+                    if 'out of memory' not in str(e) or patch_batch_size == 1:
+                        raise
+                    oom = True
+                if oom:
+                    # outside of the except block, so that the traceback no longer holds on to the activations
+                    x = inputs = out = pred = idx = None
+                    torch.cuda.empty_cache()
+                    patch_batch_size = max(1, patch_batch_size // 2)
+                    print("out of GPU memory, reducing patch batch size to", patch_batch_size)
+                    continue
+
+                with torch.no_grad():
+                    aggregated_results.index_add_(1, idx, pred)
+                    if fold == 0:
+                        aggregated_nb_of_predictions.index_add_(0, idx, gaussian_flat.repeat(n))
+                del x, pred, idx
+                if timed_start is None:
+                    if torch.cuda.is_available():
+                        torch.cuda.synchronize()
+                    timed_start = time()
+                else:
+                    timed_patches += n * len(flips)
+                start = end
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        timed_seconds = time() - timed_start
+        if timed_patches == 0:
+            # there was only the warm up batch
+            timed_patches = len(locations) * len(flips)
+            timed_seconds = time() - total_start
+    finally:
+        network.do_ds = ds
+        network.train(current_mode)
+
+    aggregated_results /= aggregated_nb_of_predictions
+    if len(params) > 1:
+        aggregated_results /= len(params)
+    del aggregated_nb_of_predictions
+    if nb_file is not None:
+        os.remove(nb_file)
+    class_probabilities = aggregated_results.reshape(trainer.num_classes, *data_shape)[(slice(None),) +
+                                                                                      tuple(slicer[1:])]
+    stats = {'patch_batch_size': patch_batch_size, 'patches': timed_patches, 'seconds': timed_seconds}
+    if all_in_gpu:
+        return class_probabilities.half().cpu().numpy(), stats
+    return class_probabilities.numpy(), stats
+
+
+def warm_up_network(network, patch, mixed_precision=True):
+    """
+    One forward pass on a patch so that cuDNN autotuning for that input shape is not part of any timing.
+    """
+    context = autocast if mixed_precision else no_op
+    ds = network.do_ds
+    current_mode = network.training
+    network.do_ds = False
+    network.eval()
+    try:
+        with torch.no_grad(), context():
+            network(patch)
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+    finally:
+        network.do_ds = ds
+        network.train(current_mode)
+
+
+def benchmark_patch_batching(trainer, data, do_mirroring=True, mirror_axes=(0, 1, 2), step_size=0.5,
+                             patch_batch_size='auto', mixed_precision=True):
+    """
+    Times nnUNet's single patch sliding window against predict_preprocessed_data_batched on the same data with the
+    currently loaded parameters, both without warm up, and prints the speedup. Nothing else may run on the GPU
+    meanwhile.
+    :return: the patch batch size the batched path ended up with
+    """
+    num_patches = count_sliding_window_patches(trainer.patch_size, data.shape, step_size, do_mirroring, mirror_axes)
+    device = next(trainer.network.parameters()).device
+    patch = torch.zeros((1, data.shape[0]) + tuple(int(i) for i in trainer.patch_size), device=device)
+    warm_up_network(trainer.network, patch, mixed_precision)
+    del patch
+
+    start = time()
+    trainer.predict_preprocessed_data_return_seg_and_softmax(
+        data, do_mirroring=do_mirroring, mirror_axes=mirror_axes, use_sliding_window=True, step_size=step_size,
+        use_gaussian=True, all_in_gpu=False, mixed_precision=mixed_precision)
+    single = num_patches / (time() - start)
+
+    _, stats = predict_preprocessed_data_batched(trainer, data, do_mirroring, mirror_axes, step_size,
+                                                 patch_batch_size, False, mixed_precision)
+    batched = stats['patches'] / stats['seconds'] if stats['seconds'] > 0 else float('nan')
+    print("benchmark (otherwise idle GPU): single patch %.1f patches/s, patch batch size %d %.1f patches/s, "
+          "speedup %.2fx" %
+          (single, stats['patch_batch_size'], batched, batched / single))
+    return stats['patch_batch_size']
+
+
+def rescale_pet(array, in_min_max=(0, 35), out_min_max=(-1, 1)):
+    """
+    Same linear mapping as torchio's RescaleIntensity with a fixed in_min_max, applied in place to a float32 array.
+    It only depends on the voxel itself, so slabs can be rescaled independently of each other.
+    """
+    in_min, in_max = in_min_max
+    out_min, out_max = out_min_max
+    array -= in_min
+    array /= in_max - in_min
+    array *= out_max - out_min
+    array += out_min
+    return array
+
+
+def iterate_pet_slabs(pet, batch_size=16, rescale=False, slope=1., inter=0.):
+    """
+    Yields (start, end, slab) for every batch of slices predict_2d is run on. slab holds the slices
+    start - 2 ... end + 1, i.e. the 5 slice context of every slice in start ... end - 1.
+    :param pet: array that can be sliced along its first axis, for example the np.memmap of an uncompressed .nii.
+    Only the slab is kept in memory. NIfTI is stored in Fortran order, so the first axis varies fastest on disk and
+    a slab touches every page of the file. Do not pass nibabel's ArrayProxy, which reads such slices with many
+    small strided read() calls instead of through the memory map
+    :param rescale: if True the slab is rescaled with rescale_pet after reading
+    :param slope: NIfTI scl_slope, applied to every slab (the memory map holds the unscaled values)
+    :param inter: NIfTI scl_inter, applied to every slab
+    """
+    w = pet.shape[0]
+    for start in range(2, w - 2, batch_size):
+        end = min(start + batch_size, w - 2)
+        if rescale or slope != 1 or inter != 0:
+            # copy, the slab may be a view of pet (e.g. a memory-mapped .nii) and slabs overlap
+            slab = np.array(pet[start - 2:end + 2], dtype=np.float32)
+            if slope != 1 or inter != 0:
+                slab *= slope
+                slab += inter
+            if rescale:
+                slab = rescale_pet(slab)
+        else:
+            slab = np.asarray(pet[start - 2:end + 2], dtype=np.float32)
+        yield start, end, slab
+
+
+def load_2d_model(model_path):
     model = smp.Unet(encoder_name='timm-res2net50_26w_4s',
                      encoder_weights=None,
                      encoder_depth=5, 
@@ -43,17 +534,106 @@ def predict_2d(model_path, input_folder):
     model.load_state_dict(torch.load(join(model_path, 'fold_0/epoch_030.pth')))
     model.cuda()
     model.eval()
-    transform = torchio.Compose([
-        torchio.transforms.RescaleIntensity(out_min_max=(-1, 1), 
-                                            in_min_max=(0, 35)),
-    ])
-    pet_path = os.path.join(input_folder, 'TCIA_001_0000.nii.gz')
-    pet = torchio.ScalarImage(pet_path)
-    pet = transform(pet)
-    pet = pet.numpy()
+    return model
+
+
+def measure_2d_gpu_memory(model_path, batch_size=16):
+    """
+    GPU memory in bytes predict_2d needs: its parameters and one batch of slices. Must be called while nothing
+    else runs on the GPU, the peak memory statistics are global to the device.
+    """
+    torch.cuda.synchronize()
+    torch.cuda.reset_peak_memory_stats()
+    baseline = torch.cuda.memory_allocated()
+    model = load_2d_model(model_path)
+    oom = False
+    try:
+        with torch.no_grad():
+            torch.softmax(model(torch.zeros((batch_size, 5, 320, 384), device='cuda')), dim=1)
+        torch.cuda.synchronize()
+    except RuntimeError as e:
+        if 'out of memory' not in str(e):
+            raise
+        oom = True
+    peak = torch.cuda.max_memory_allocated() - baseline
+    del model
+    torch.cuda.empty_cache()
+    if oom:
+        # predict_2d_in_stream will reduce its batch size, leave it all the GPU memory there is
+        return torch.cuda.mem_get_info()[0]
+    return peak
+
+
+def tune_patch_batch_size_next_to_2d(trainer, params, model_path, do_mirroring=True, mixed_precision=True):
+    """
+    Tunes patch_batch_size='auto' once for all cases with the first fold's parameters, leaving the GPU memory
+    predict_2d needs to the 2D branch. Nothing else may run on the GPU meanwhile.
+    """
+    reserve_2d = measure_2d_gpu_memory(model_path)
+    trainer.load_checkpoint_ram(params[0], False)
+    patch = torch.zeros((1, trainer.num_input_channels) + tuple(int(i) for i in trainer.patch_size), device='cuda')
+    ds = trainer.network.do_ds
+    trainer.network.do_ds = False
+    trainer.network.eval()
+    batch_size = tune_patch_batch_size(
+        trainer.network, patch, len(get_mirror_flips(do_mirroring, trainer.data_aug_params['mirror_axes'])),
+        np.iinfo(np.int32).max, mixed_precision, reserve=reserve_2d)
+    trainer.network.do_ds = ds
+    del patch
+    print("patch batch size: %d (%.2f GB of GPU memory left to the 2D branch)" % (batch_size, reserve_2d / 1e9))
+    return batch_size
+
+
+def decompress_nifti(nii_gz_file, nii_file):
+    """
+    Decompresses a .nii.gz into a .nii chunk by chunk, without loading the image.
+    """
+    with gzip.open(nii_gz_file, 'rb') as src, open(nii_file, 'wb') as dst:
+        shutil.copyfileobj(src, dst, 16 * 1024 * 1024)
+    return nii_file
+
+
+def predict_2d(model_path, pet_path, stream=False, output_file=None, batch_size=16, pet_cache_file=None):
+    """
+    Slice-wise foreground probability of the 2D network for a PET volume. Every slice is predicted with its two
+    neighbours on both sides and the probabilities of each batch of slices are written straight into the output.
+    :param stream: if True the PET is read lazily through nibabel's dataobj, slab by slab, instead of loading and
+    rescaling the whole volume first. Slabs are cut along the fastest varying axis on disk, so every slab reads the
+    whole file. A .nii.gz is therefore decompressed once into pet_cache_file, which is then sliced through a
+    np.memmap, rather than decompressing it from the start for every slab
+    :param output_file: if not None the output is a .npy file memory-mapped from there instead of being held in
+    memory
+    :param batch_size: number of slices per forward pass, does not change the result
+    :param pet_cache_file: where to decompress a .nii.gz PET to if stream. None: a temporary file. It is removed
+    once the prediction is done
+    :return: foreground probability (w, h, d)
+    """
+    model = load_2d_model(model_path)
+    if stream:
+        if pet_path.endswith('.gz'):
+            if pet_cache_file is None:
+                fd, pet_cache_file = tempfile.mkstemp(suffix='.nii')
+                os.close(fd)
+            pet_path = decompress_nifti(pet_path, pet_cache_file)
+        else:
+            pet_cache_file = None
+        proxy = nib.load(pet_path, mmap=True).dataobj
+        # slice the np.memmap itself, slicing the ArrayProxy goes through many small reads
+        pet = proxy.get_unscaled()
+        slabs = iterate_pet_slabs(pet, batch_size, rescale=True, slope=float(proxy.slope), inter=float(proxy.inter))
+        del proxy
+    else:
+        transform = torchio.Compose([
+            torchio.transforms.RescaleIntensity(out_min_max=(-1, 1), 
+                                                in_min_max=(0, 35)),
+        ])
+        pet = torchio.ScalarImage(pet_path)
+        pet = transform(pet)
+        pet = pet.numpy()[0]
+        slabs = iterate_pet_slabs(pet, batch_size)
    
-    c, w, h, d = pet.shape
-    output = np.zeros((w, 400, 400))  # final result
+    w, h, d = pet.shape[:3]
+    output = allocate_buffer((w, h, d), np.float32, output_file)  # final result
 
     value = 320
     upper = (400 - value) // 2
@@ -64,46 +644,54 @@ def predict_2d(model_path, input_folder):
     right = left + value
 
     # In Predicting
-    batch_size = 16
-    res = []
-    for i in range(2, w-2, batch_size):
-        if i + batch_size > w-2:
-            start = i
-            end = w-2
-        else:
-            start = i
-            end = i + batch_size
-
-        x0 = torch.tensor(pet[0, start-2:end-2 ])
-        x1 = torch.tensor(pet[0, start-1:end-1 ])
-        x2 = torch.tensor(pet[0, start  :end   ])
-        x3 = torch.tensor(pet[0, start+1:end+1 ])
-        x4 = torch.tensor(pet[0, start+2:end+2 ])
-
-        x0 = x0.unsqueeze(1)
-        x1 = x1.unsqueeze(1)
-        x2 = x2.unsqueeze(1)
-        x3 = x3.unsqueeze(1)
-        x4 = x4.unsqueeze(1)
-
-        pet_tensor = torch.cat([x0, x1, x2, x3, x4], dim=1)
+    for start, end, slab in slabs:
+        n = end - start
+        pet_tensor = torch.from_numpy(np.stack([slab[k:k + n] for k in range(5)], axis=1))
         pet_tensor = F.interpolate(pet_tensor, (400, 400), mode='bilinear')
         pet_tensor = pet_tensor[:, :, upper:down, left:right]
         pet_tensor = pet_tensor.cuda()
 
         with torch.no_grad():
             r = model(pet_tensor)
-        r = torch.softmax(r, dim=1)[:, 1:2]
-        r = r.squeeze(1).cpu().numpy()
-        res.append(r)
-
-    out = np.concatenate(res, axis=0)
-    output[2:-2, upper:down, left:right] = out
-    result = torch.tensor(output, dtype=torch.float32)
-    result = result.unsqueeze(0)
-    result = F.interpolate(result, (h, d), mode='bilinear')
-    
-    return result[0] 
+        r = torch.softmax(r, dim=1)[:, 1]
+        r = r.cpu()
+
+        # the network only sees the center crop, everything else is background
+        result = torch.zeros((1, n, 400, 400), dtype=torch.float32)
+        result[0, :, upper:down, left:right] = r
+        result = F.interpolate(result, (h, d), mode='bilinear')
+        output[start:end] = result[0].numpy()
+
+    if stream and pet_cache_file is not None:
+        del pet, slabs
+        os.remove(pet_cache_file)
+    return torch.from_numpy(output)
+
+
+def predict_2d_in_stream(model_path, pet_path, stream=False, output_file=None, batch_size=16, pet_cache_file=None):
+    """
+    Runs predict_2d on its own CUDA stream so that its kernels do not queue up behind the 3D sliding window that
+    runs on the default stream at the same time. The 3D branch may have taken more GPU memory than was left for
+    us, so if we run out of memory the case is predicted again with half the batch size.
+    """
+    if not torch.cuda.is_available():
+        return predict_2d(model_path, pet_path, stream, output_file, batch_size, pet_cache_file)
+    while True:
+        oom = False
+        try:
+            cuda_stream = torch.cuda.Stream()
+            with torch.cuda.stream(cuda_stream):
+                result = predict_2d(model_path, pet_path, stream, output_file, batch_size, pet_cache_file)
+            cuda_stream.synchronize()
+            return result
+        except RuntimeError as e:
+            if 'out of memory' not in str(e) or batch_size == 1:
+                raise
+            oom = True
+        if oom:
+            torch.cuda.empty_cache()
+            batch_size = max(1, batch_size // 2)
+            print("out of GPU memory in the 2D branch, reducing its batch size to", batch_size)
         
     
 def check_input_folder_and_return_caseIDs(input_folder, expected_num_modalities):
@@ -148,7 +736,9 @@ def predict_from_folder(model: str, input_folder: str, output_folder: str, folds
                         part_id: int, num_parts: int, tta: bool, mixed_precision: bool = True,
                         overwrite_existing: bool = True, mode: str = 'normal', overwrite_all_in_gpu: bool = None,
                         step_size: float = 0.5, checkpoint_name: str = "model_final_checkpoint",
-                        segmentation_export_kwargs: dict = None, disable_postprocessing: bool = False):
+                        segmentation_export_kwargs: dict = None, disable_postprocessing: bool = False,
+                        memory_budget: float = None, patch_batch_size: Union[int, str] = None,
+                        stream_2d: bool = False, benchmark: bool = False):
     """
         here we use the standard naming scheme to generate list_of_lists and output_files needed by predict_cases
     :param model:
@@ -164,6 +754,10 @@ def predict_from_folder(model: str, input_folder: str, output_folder: str, folds
     :param tta:
     :param mixed_precision:
     :param overwrite_existing: if not None then it will be overwritten with whatever is in there. None is default (no overwrite)
+    :param memory_budget: host memory in bytes predict_cases may use. None: derive it from the container memory limit
+    :param patch_batch_size: see predict_cases
+    :param stream_2d: see predict_cases
+    :param benchmark: see predict_cases
     :return:
     """
     maybe_mkdir_p(output_folder)
@@ -201,14 +795,18 @@ def predict_from_folder(model: str, input_folder: str, output_folder: str, folds
                              all_in_gpu=all_in_gpu,
                              step_size=step_size, checkpoint_name=checkpoint_name,
                              segmentation_export_kwargs=segmentation_export_kwargs,
-                             disable_postprocessing=disable_postprocessing)
+                             disable_postprocessing=disable_postprocessing, memory_budget=memory_budget,
+                             patch_batch_size=patch_batch_size, stream_2d=stream_2d,
+                             benchmark=benchmark)
 
 
 def predict_cases(model, list_of_lists, output_filenames, folds, save_npz, num_threads_preprocessing,
                   num_threads_nifti_save, segs_from_prev_stage=None, do_tta=True, mixed_precision=True,
                   overwrite_existing=False,
                   all_in_gpu=False, step_size=0.5, checkpoint_name="model_final_checkpoint",
-                  segmentation_export_kwargs: dict = None, disable_postprocessing: bool = False):
+                  segmentation_export_kwargs: dict = None, disable_postprocessing: bool = False,
+                  memory_budget: float = None, patch_batch_size: Union[int, str] = None, stream_2d: bool = False,
+                  benchmark: bool = False):
     """
     :param segmentation_export_kwargs:
     :param model: folder where the model is saved, must contain fold_x subfolders
@@ -223,6 +821,17 @@ def predict_cases(model, list_of_lists, output_filenames, folds, save_npz, num_t
     :param do_tta: default: True, can be set to False for a 8x speedup at the cost of a reduced segmentation quality
     :param overwrite_existing: default: True
     :param mixed_precision: if None then we take no action. If True/False we overwrite what the model has in its init
+    :param memory_budget: host memory in bytes we may use. For each case the softmax accumulation buffer is kept in
+    float32, float16 or memory-mapped to disk, whichever is the first to keep the estimated peak under this budget.
+    None: derive it from the container memory limit
+    :param patch_batch_size: None: nnUNet's sliding window, one patch (and its mirrored copies) at a time. int or
+    'auto': number of patch locations per forward pass, see predict_preprocessed_data_batched. Cases predicted out of
+    core are always batched, with 'auto' if None
+    :param stream_2d: if True the 2D branch decompresses the PET once into an uncompressed .nii next to the output,
+    reads it slab by slab through a memory map and writes its probabilities into a memory-mapped file next to the
+    output, see predict_2d
+    :param benchmark: if True, the first case is additionally predicted with fold 0 by nnUNet's single patch sliding
+    window and by the batched one (patch_batch_size, 'auto' if None) and the patches/s of both are printed
     :return:
     """
     assert len(list_of_lists) == len(output_filenames)
@@ -252,6 +861,9 @@ def predict_cases(model, list_of_lists, output_filenames, folds, save_npz, num_t
 
         print("number of cases that still need to be predicted:", len(cleaned_output_files))
 
+    if memory_budget is None:
+        memory_budget = get_memory_budget()
+
     print("emptying cuda cache")
     torch.cuda.empty_cache()
 
@@ -277,132 +889,184 @@ def predict_cases(model, list_of_lists, output_filenames, folds, save_npz, num_t
     preprocessing = preprocess_multithreaded(trainer, list_of_lists, cleaned_output_files, num_threads_preprocessing,
                                              segs_from_prev_stage)
 
+    # the 2D branch does not depend on the 3D one until fusion, so it runs in a separate thread. It starts on the
+    # next case as soon as the current case's 2D result has been picked up, i.e. while the current case is being
+    # fused and exported. Looking only one case ahead bounds the memory held by pending 2D results
+    pet_files = {o: l[0] for o, l in zip(cleaned_output_files, list_of_lists)}
+
+    # 'auto' is only tuned if the batched path is used: here, before the 2D branch starts to allocate GPU memory,
+    # if it was asked for, otherwise the first time a case has to go out of core
+    auto_batch_size = 'auto'
+    if patch_batch_size == 'auto' and torch.cuda.is_available() and len(cleaned_output_files) > 0:
+        auto_batch_size = tune_patch_batch_size_next_to_2d(trainer, params, model, do_tta, mixed_precision)
+    if patch_batch_size == 'auto':
+        patch_batch_size = auto_batch_size
+
+    executor = ThreadPoolExecutor(max_workers=1)
+    pending_2d = {}
+
+    def submit_2d(case_idx):
+        if case_idx < len(cleaned_output_files) and cleaned_output_files[case_idx] not in pending_2d:
+            o = cleaned_output_files[case_idx]
+            output_file_2d = o[:-7] + "_2d.npy" if stream_2d else None
+            pet_cache_file = o[:-7] + "_2d_pet.nii" if stream_2d else None
+            pending_2d[o] = executor.submit(predict_2d_in_stream, model, pet_files[o], stream_2d, output_file_2d,
+                                            16, pet_cache_file)
+
+    submit_2d(0)
+
     print("starting prediction...")
+    benchmark_done = False
+    warmed_up = False
     all_output_files = []
-    for preprocessed in preprocessing:
-        output_filename, (d, dct) = preprocessed
-        all_output_files.append(all_output_files)
-        if isinstance(d, str):
-            data = np.load(d)
-            os.remove(d)
-            d = data
-
-        print("predicting", output_filename)
-        trainer.load_checkpoint_ram(params[0], False)
-        softmax = trainer.predict_preprocessed_data_return_seg_and_softmax(
-            d, do_mirroring=do_tta, mirror_axes=trainer.data_aug_params['mirror_axes'], use_sliding_window=True,
-            step_size=step_size, use_gaussian=True, all_in_gpu=all_in_gpu,
-            mixed_precision=mixed_precision)[1]
-
-        for p in params[1:]:
-            trainer.load_checkpoint_ram(p, False)
-            softmax += trainer.predict_preprocessed_data_return_seg_and_softmax(
-                d, do_mirroring=do_tta, mirror_axes=trainer.data_aug_params['mirror_axes'], use_sliding_window=True,
-                step_size=step_size, use_gaussian=True, all_in_gpu=all_in_gpu,
-                mixed_precision=mixed_precision)[1]
-
-        if len(params) > 1:
-            softmax /= len(params)
-
-        transpose_forward = trainer.plans.get('transpose_forward')
-        if transpose_forward is not None:
+    try:
+        for preprocessed in preprocessing:
+            output_filename, (d, dct) = preprocessed
+            all_output_files.append(all_output_files)
+            if isinstance(d, str):
+                data = np.load(d)
+                os.remove(d)
+                d = data
+
+            case_idx = cleaned_output_files.index(output_filename)
+            submit_2d(case_idx)
+            print("predicting", output_filename)
+            planned_batch_size = patch_batch_size or auto_batch_size
+            plan = plan_memory(d.shape, dct['original_size_of_raw_data'], trainer.num_classes, memory_budget,
+                               all_in_gpu, patch_batch_size is not None, stream_2d, trainer.patch_size,
+                               planned_batch_size if planned_batch_size != 'auto' else None)
+            num_patches = count_sliding_window_patches(trainer.patch_size, d.shape, step_size, do_tta,
+                                                       trainer.data_aug_params['mirror_axes'])
+            transpose_forward = trainer.plans.get('transpose_forward')
             transpose_backward = trainer.plans.get('transpose_backward')
-            softmax = softmax.transpose([0] + [i + 1 for i in transpose_backward])
-        
-        softmax_2d = predict_2d(model, input_folder)
-        softmax_2d = rearrange(softmax_2d, "w h d -> d h w").numpy()
-        softmax_3d = softmax[1]
-        result = np.zeros_like(softmax_3d)
-        
-        high = (softmax_3d > 0.90)
-        low = (softmax_3d > 0.50)
-        cue = (softmax_2d > 0.50)
-        
-        comp = con_comp(high)
-        high_record = [0]
-        for idx in range(1, comp.max() + 1):
-            comp_mask = np.isin(comp, idx)
-            high_record.append(np.sum(comp_mask))
-        comp = con_comp(low)
-        low_record = [0]
-        for idx in range(1, comp.max() + 1):
-            comp_mask = np.isin(comp, idx)
-            low_record.append(np.sum(comp_mask))
-        
-        if np.max(high_record) < 50 and np.max(low_record) < 150:
-            pass
-        else:
-            for idx in range(1, comp.max() + 1):
-                comp_mask = np.isin(comp, idx)
-                overlap_3d = np.sum(comp_mask * high)
-                overlap_2d = np.max(comp_mask * cue)
-                if overlap_3d < 20 or overlap_2d == 0:
-                    result[(softmax_3d * comp_mask) == (softmax_3d * comp_mask).max()] = 1
-                elif overlap_3d > 30000:
-                    result = result + comp_mask * high
-                else:
-                    result = result + comp_mask
-        
-        if np.max(high_record) < 50 and np.max(low_record) < 150:
-            pass
-        else:
-            comp = con_comp(cue)
-            cue_record = [0]
-            for idx in range(1, comp.max() + 1):
-                comp_mask = np.isin(comp, idx)
-                cue_record.append(np.sum(comp_mask))
-            retain = len(low_record) + 6
-            if len(cue_record) >= retain:
-                cue_record.sort()
-                area = cue_record[-retain]
+
+            # the batched path returns the batch size it ended up with (smaller after running out of GPU memory), the
+            # other folds of the case go on with that
+            case_batch_size = patch_batch_size
+            if benchmark and not benchmark_done:
+                # the 2D branch of this case is already running, let it finish so that both paths are timed on an
+                # otherwise idle GPU. The result stays in the future for the fusion
+                pending_2d[output_filename].result()
+                trainer.load_checkpoint_ram(params[0], False)
+                case_batch_size = benchmark_patch_batching(trainer, d, do_tta, trainer.data_aug_params['mirror_axes'],
+                                                           step_size, patch_batch_size or auto_batch_size,
+                                                           mixed_precision)
+                if patch_batch_size is None:
+                    case_batch_size = None
+                benchmark_done = True
+            elif case_batch_size is None and not warmed_up:
+                # keep cuDNN autotuning out of the single patch timing
+                patch = torch.zeros((1, d.shape[0]) + tuple(int(i) for i in trainer.patch_size),
+                                    device=next(trainer.network.parameters()).device)
+                warm_up_network(trainer.network, patch, mixed_precision)
+                del patch
+            warmed_up = True
+
+            if plan['memmap']:
+                # out of core: all folds are aggregated into a single memory-mapped buffer, which is then copied into
+                # the memory-mapped softmax. Neither of them has to fit into memory
+                aggregation_file = output_filename[:-7] + "_aggregation.npy"
+                if case_batch_size is None and auto_batch_size == 'auto' and torch.cuda.is_available():
+                    # the 2D branch of this case is running, tune on an otherwise idle GPU. The next case's 2D branch
+                    # is only started after the fusion, so it is not submitted meanwhile
+                    pending_2d[output_filename].result()
+                    auto_batch_size = tune_patch_batch_size_next_to_2d(trainer, params, model, do_tta,
+                                                                       mixed_precision)
+                    # the plan assumed a single patch location per batch. Only the out of core estimate depends on
+                    # it, so this still goes out of core, but the printed peaks are now right
+                    plan = plan_memory(d.shape, dct['original_size_of_raw_data'], trainer.num_classes,
+                                       memory_budget, all_in_gpu, False, stream_2d, trainer.patch_size,
+                                       auto_batch_size)
+                aggregated, stats = predict_preprocessed_data_batched(
+                    trainer, d, do_mirroring=do_tta, mirror_axes=trainer.data_aug_params['mirror_axes'],
+                    step_size=step_size, patch_batch_size=case_batch_size or auto_batch_size, all_in_gpu=False,
+                    mixed_precision=mixed_precision, params=params, aggregation_file=aggregation_file)
+                print("%d patches in %.2f s, %.1f patches/s (out of core, patch batch size %d)" %
+                      (stats['patches'], stats['seconds'], stats['patches'] / max(stats['seconds'], 1e-6),
+                       stats['patch_batch_size']))
+                if transpose_forward is not None:
+                    aggregated = aggregated.transpose([0] + [i + 1 for i in transpose_backward])
+                softmax = allocate_buffer(aggregated.shape, plan['dtype'], output_filename[:-7] + ".npy")
+                softmax[:] = aggregated
+                del aggregated
+                os.remove(aggregation_file)
             else:
-                area = 35
-            for idx in range(1, comp.max() + 1):
-                comp_mask = np.isin(comp, idx)
-                overlap = np.sum(comp_mask * result)
-                if overlap > 0:
-                    continue
-                elif np.max(comp_mask * softmax_3d) > 0.10:
-                    result[(softmax_3d * comp_mask) == (softmax_3d * comp_mask).max()] = 1
-                elif np.sum(comp_mask) <= area:
-                    continue
-                elif np.max(comp_mask * softmax_3d) < 1e-5:
-                    continue
-                else:
-                    result[(softmax_3d * comp_mask) == (softmax_3d * comp_mask).max()] = 1
-        
-        softmax[1] = result
-        softmax[0] = 1 - result
-        
-        if save_npz:
-            npz_file = output_filename[:-7] + ".npz"
-        else:
-            npz_file = None
+                # folds are predicted one after the other and accumulated in place, so at most one fold's softmax is
+                # alive on top of the accumulation buffer
+                softmax = None
+                for p in params:
+                    trainer.load_checkpoint_ram(p, False)
+                    if case_batch_size is None:
+                        start = time()
+                        fold_softmax = trainer.predict_preprocessed_data_return_seg_and_softmax(
+                            d, do_mirroring=do_tta, mirror_axes=trainer.data_aug_params['mirror_axes'],
+                            use_sliding_window=True, step_size=step_size, use_gaussian=True, all_in_gpu=all_in_gpu,
+                            mixed_precision=mixed_precision)[1]
+                        elapsed = time() - start
+                        print("%d patches in %.2f s, %.1f patches/s (single patch)" %
+                              (num_patches, elapsed, num_patches / elapsed))
+                    else:
+                        fold_softmax, stats = predict_preprocessed_data_batched(
+                            trainer, d, do_mirroring=do_tta, mirror_axes=trainer.data_aug_params['mirror_axes'],
+                            step_size=step_size, patch_batch_size=case_batch_size, all_in_gpu=all_in_gpu,
+                            mixed_precision=mixed_precision)
+                        case_batch_size = stats['patch_batch_size']
+                        print("%d patches in %.2f s, %.1f patches/s (patch batch size %d)" %
+                              (stats['patches'], stats['seconds'], stats['patches'] / max(stats['seconds'], 1e-6),
+                               case_batch_size))
+                    if transpose_forward is not None:
+                        fold_softmax = fold_softmax.transpose([0] + [i + 1 for i in transpose_backward])
 
-        if hasattr(trainer, 'regions_class_order'):
-            region_class_order = trainer.regions_class_order
-        else:
-            region_class_order = None
-
-        """There is a problem with python process communication that prevents us from communicating objects 
-        larger than 2 GB between processes (basically when the length of the pickle string that will be sent is 
-        communicated by the multiprocessing.Pipe object then the placeholder (I think) does not allow for long 
-        enough strings (lol). This could be fixed by changing i to l (for long) but that would require manually 
-        patching system python code. We circumvent that problem here by saving softmax_pred to a npy file that will 
-        then be read (and finally deleted) by the Process. save_segmentation_nifti_from_softmax can take either 
-        filename or np.ndarray and will handle this automatically"""
-        bytes_per_voxel = 4
-        if all_in_gpu:
-            bytes_per_voxel = 2  # if all_in_gpu then the return value is half (float16)
-        if np.prod(softmax.shape) > (2e9 / bytes_per_voxel * 0.85):  # * 0.85 just to be save
-            print(
-                "This output is too large for python process-process communication. Saving output temporarily to disk")
-            np.save(output_filename[:-7] + ".npy", softmax)
-            softmax = output_filename[:-7] + ".npy"
-
-        results.append(save_segmentation_nifti_from_softmax(softmax, output_filename, dct, interpolation_order,
-                                                            region_class_order, None, None,
-                                                            npz_file, None, force_separate_z, interpolation_order_z))
+                    if softmax is None:
+                        softmax = fold_softmax.astype(plan['dtype'], copy=False)
+                    else:
+                        softmax += fold_softmax
+                    del fold_softmax
+
+                if len(params) > 1:
+                    softmax /= len(params)
+
+            start = time()
+            softmax_2d = pending_2d.pop(output_filename).result()
+            print("waited %.2f s for the 2D branch" % (time() - start))
+            submit_2d(case_idx + 1)
+            softmax_2d = rearrange(softmax_2d, "w h d -> d h w").numpy()
+            # fuse in float32 whatever the storage dtype, float16 would merge the peak voxel with its neighbours
+            result = fuse_predictions(softmax[1].astype(np.float32, copy=False), softmax_2d)
+            del softmax_2d
+            if stream_2d:
+                os.remove(output_filename[:-7] + "_2d.npy")
+
+            softmax[1] = result
+            softmax[0] = 1 - result
+            del result
+
+            if save_npz:
+                npz_file = output_filename[:-7] + ".npz"
+            else:
+                npz_file = None
+
+            if hasattr(trainer, 'regions_class_order'):
+                region_class_order = trainer.regions_class_order
+            else:
+                region_class_order = None
+
+            if plan['memmap']:
+                # the softmax already lives in a .npy file, save_segmentation_nifti_from_softmax loads and deletes it
+                softmax.flush()
+                softmax = softmax.filename
+
+            results.append(save_segmentation_nifti_from_softmax(softmax, output_filename, dct, interpolation_order,
+                                                                region_class_order, None, None, npz_file, None,
+                                                                force_separate_z, interpolation_order_z))
+    finally:
+        # if anything failed, do not let the 2D branch predict cases nobody is waiting for and clean up behind us
+        executor.shutdown(wait=True, cancel_futures=True)
+        for o in cleaned_output_files:
+            for leftover in (o[:-7] + ".npy", o[:-7] + "_2d.npy", o[:-7] + "_2d_pet.nii", o[:-7] + "_aggregation.npy",
+                             o[:-7] + "_aggregation_nb.npy"):
+                if isfile(leftover):
+                    os.remove(leftover)
 
     print("inference done. Now waiting for the segmentation export to finish...")
     # _ = [i.get() for i in results]
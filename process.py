@@ -109,6 +109,10 @@ class Autopet_baseline():  # SegmentationAlgorithm is not inherited in this clas
         trainer_class_name = default_trainer  #args.trainer_class_name
         cascade_trainer_class_name = default_cascade_trainer  # args.cascade_trainer_class_name
         disable_mixed_precision = False  #args.disable_mixed_precision
+        memory_budget = None  # args.memory_budget, in bytes. None: derived from the container memory limit
+        patch_batch_size = None  # args.patch_batch_size, None: one patch at a time, int or 'auto': batched
+        stream_2d = False  # args.stream_2d, read the PET slab by slab in the 2D branch
+        benchmark = False  # args.benchmark, compare single patch and batched sliding window on the first case
         plans_identifier = default_plans_identifier
         chk = 'model_best'
 
@@ -179,7 +183,9 @@ class Autopet_baseline():  # SegmentationAlgorithm is not inherited in this clas
                             num_threads_nifti_save, lowres_segmentations, part_id, num_parts, not disable_tta,
                             overwrite_existing=overwrite_existing, mode=mode, overwrite_all_in_gpu=all_in_gpu,
                             mixed_precision=not disable_mixed_precision,
-                            step_size=step_size, checkpoint_name=chk)
+                            step_size=step_size, checkpoint_name=chk, memory_budget=memory_budget,
+                            patch_batch_size=patch_batch_size, stream_2d=stream_2d,
+                            benchmark=benchmark)
 
         print("nnUNet segmentation done!")
         if not os.path.exists(os.path.join(self.result_path, self.nii_seg_file)):